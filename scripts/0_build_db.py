@@ -8,17 +8,20 @@
 
 from unicodedata import normalize as unicodedata_normalize
 from argparse import ArgumentParser
-from json import loads as json_loads
-from os import walk as os_walk
-from os.path import isfile as os_path_isfile, isdir as os_path_isdir, join as os_path_join
+from json import loads as stdlib_json_loads
+from orjson import loads as orjson_loads, JSONDecodeError
+from os import scandir as os_scandir
+from os.path import isfile as os_path_isfile, isdir as os_path_isdir
 from multiprocessing import Pool
 from logging import getLogger, INFO, Formatter, StreamHandler
 from importlib.util import spec_from_file_location, module_from_spec
-from bz2 import open as bz2_open
+from bz2 import decompress as bz2_decompress
 from sqlite3 import connect as sqlite3_connect
 from pickle import dumps as pickle_dumps
+from sys import intern as sys_intern
 from tqdm import tqdm
-from spacy import load as spacy_load
+from zstandard import ZstdCompressor, ZstdError, train_dictionary
+from spacy import load as spacy_load, require_gpu
 
 
 logger = getLogger()
@@ -28,18 +31,23 @@ console = StreamHandler()
 console.setFormatter(fmt)
 logger.addHandler(console)
 
-nlp = spacy_load("en_core_web_lg", disable=['parser'])
-
 # ------------------------------------------------------------------------------
 # Import helper
 # ------------------------------------------------------------------------------
 
 PREPROCESS_FN = None
+nlp = None
+NER_BATCH_SIZE = 256
 
-def init(filename):
-    global PREPROCESS_FN
+def init(filename, gpu=False):
+    global PREPROCESS_FN, nlp, NER_BATCH_SIZE
     if filename:
         PREPROCESS_FN = import_module(filename).preprocess
+    if gpu:
+        require_gpu()
+        NER_BATCH_SIZE = 2048
+    # Load spacy per worker so the parent process never holds the model
+    nlp = spacy_load("en_core_web_lg", disable=['tagger', 'parser'])
 
 
 def import_module(filename):
@@ -55,24 +63,51 @@ def import_module(filename):
 # ------------------------------------------------------------------------------
 
 
+def json_loads(data):
+    """Parse JSON with orjson, falling back to the stdlib parser for input orjson rejects."""
+    # orjson refuses lone surrogates and NaN/Infinity, which the stdlib accepts
+    try:
+        return orjson_loads(data)
+    except JSONDecodeError:
+        return stdlib_json_loads(data)
+
+
+def normalize(text):
+    """Resolve different type of unicode encodings."""
+    # ASCII text is already in NFD form, so skip the call for the common case
+    return text if text.isascii() else unicodedata_normalize('NFD', text)
+
+
 def iter_files(path):
     """Walk through all files located under a root path."""
+    # Validate eagerly so a bad path fails here rather than inside the pool
     if os_path_isfile(path):
-        yield path
+        return iter([path])
     elif os_path_isdir(path):
-        for dirpath, _, filenames in os_walk(path):
-            for f in filenames:
-                yield os_path_join(dirpath, f)
+        return iter_dir_files(path)
     else:
         raise RuntimeError('Path %s is invalid' % path)
 
 
+def iter_dir_files(path):
+    """Lazily yield files under a directory, without following directory symlinks."""
+    with os_scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_dir_files(entry.path)
+            elif not entry.is_dir():
+                yield entry.path
+
+
 def get_contents(filename):
     """Parse the contents of a file. Each line is a JSON encoded document."""
-    global PREPROCESS_FN
+    global PREPROCESS_FN, nlp, NER_BATCH_SIZE
     documents = []
-    with bz2_open(filename, 'rb') as f:
-        for line in f:
+    sentences = []
+    text_ners = []
+    # Files in the dump are smaller than a single bz2 block, so decompress in one shot
+    with open(filename, 'rb') as f:
+        for line in bz2_decompress(f.read()).splitlines():
             # Parse document
             doc = json_loads(line)
             # Maybe preprocess the document with custom function
@@ -88,18 +123,59 @@ def get_contents(filename):
             assert len_doc_text == len(doc_text_with_links)
             _text, _text_with_links = pickle_dumps(doc_text), pickle_dumps(doc_text_with_links)
 
-            _text_ner = []
-            for sent in doc_text:
-                ent_list = [(ent.text, ent.start_char, ent.end_char, ent.label_) for ent in nlp(sent).ents]
-                _text_ner.append(ent_list)
-            _text_ner_str = pickle_dumps(_text_ner)
+            doc_idx = len(documents)
+            sentences.extend((sent, (doc_idx, sent_idx)) for sent_idx, sent in enumerate(doc_text))
+            text_ners.append([None] * len_doc_text)
 
-            documents.append((unicodedata_normalize('NFD', doc.pop('id')), doc.pop('url'), doc.pop('title'), _text, _text_with_links, _text_ner_str, len_doc_text))
+            documents.append([normalize(doc.pop('id')), doc.pop('url'), doc.pop('title'), _text, _text_with_links, None, len_doc_text])
 
-    return documents
+    # Run NER over all sentences of the file as one stream so spacy can form full batches;
+    # the pool already parallelizes across files
+    for spacy_doc, (doc_idx, sent_idx) in nlp.pipe(sentences, as_tuples=True, batch_size=NER_BATCH_SIZE):
+        # Interned labels are memoized by pickle, so each label is written once per document
+        text_ners[doc_idx][sent_idx] = [(ent.text, ent.start_char, ent.end_char, sys_intern(ent.label_)) for ent in spacy_doc.ents]
+
+    for document, _text_ner in zip(documents, text_ners):
+        document[5] = pickle_dumps(_text_ner)
+
+    return [tuple(document) for document in documents]
+
+
+# ------------------------------------------------------------------------------
+# Blob compression.
+# ------------------------------------------------------------------------------
 
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112640
+# Rows are buffered until this many blob bytes are available to train the dictionary
+ZSTD_SAMPLE_BYTES = 100 * 1024 * 1024
 
-def store_contents(data_path, save_path, preprocess, num_workers=None):
+
+def blob_size(rows):
+    """Total size of the text, text_with_links and text_ner blobs of rows."""
+    return sum(len(blob) for row in rows for blob in row[3:6])
+
+
+def train_compressor(cursor, rows):
+    """Train a zstd dictionary on the blobs of rows and store it in the meta table."""
+    samples = [blob for row in rows for blob in row[3:6]]
+    try:
+        zstd_dict = train_dictionary(ZSTD_DICT_SIZE, samples)
+    except ZstdError:
+        logger.warning('Too little data to train a zstd dictionary, compressing without one.')
+        return ZstdCompressor(level=ZSTD_LEVEL)
+    cursor.execute("INSERT INTO meta VALUES (?,?)", ('zstd_dict', zstd_dict.as_bytes()))
+    return ZstdCompressor(level=ZSTD_LEVEL, dict_data=zstd_dict)
+
+
+def compress_rows(compressor, rows):
+    """Compress the text, text_with_links and text_ner blobs of rows."""
+    compress = compressor.compress
+    return [(doc_id, url, title, compress(text), compress(text_with_links), compress(text_ner), sent_num)
+            for doc_id, url, title, text, text_with_links, text_ner, sent_num in rows]
+
+
+def store_contents(data_path, save_path, preprocess, num_workers=None, gpu=False, compress=False, total=None):
     """Preprocess and store a corpus of documents in sqlite.
 
     Args:
@@ -109,23 +185,71 @@ def store_contents(data_path, save_path, preprocess, num_workers=None):
         preprocess: Path to file defining a custom `preprocess` function. Takes
           in and outputs a structured doc.
         num_workers: Number of parallel processes to use when reading docs.
+        gpu: Run spacy NER on the GPU. Defaults to a single worker, as workers
+          share the device.
+        compress: zstd-compress the blob columns with a dictionary trained on the
+          first documents, stored in the `meta` table.
+        total: Expected number of files, only used for the progress bar.
     """
     if os_path_isfile(save_path):
         raise RuntimeError(f'{save_path} already exists! Not overwriting.')
 
+    # Every worker loads its own model onto the device, so don't default to one per core
+    if gpu:
+        if num_workers is None:
+            num_workers = 1
+        elif num_workers > 2:
+            logger.warning('%d workers will each load spacy onto the GPU; 1-2 is recommended.' % num_workers)
+
+    # Stream paths to the workers rather than listing the whole dump up front
+    files = iter_files(data_path)
+
     logger.info('Reading into database...')
     conn = sqlite3_connect(save_path)
     c = conn.cursor()
-    c.execute("CREATE TABLE documents (id PRIMARY KEY, url, title, text, text_with_links, text_ner, sent_num);")
+    # Bulk load: no journal or fsyncs (a failed build leaves a file that is never
+    # resumed, so there is nothing to roll back), large page cache, a single
+    # transaction for all inserts.
+    # 64KB pages keep most multi-KB text/NER blobs off overflow pages; page_size
+    # must be set before the first table is created
+    c.executescript(
+        "PRAGMA page_size=65536;"
+        "PRAGMA locking_mode=EXCLUSIVE;"
+        "PRAGMA journal_mode=OFF;"
+        "PRAGMA synchronous=OFF;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-262144;"
+    )
+    # The unique index on id is built after the load rather than maintained per row
+    c.execute("CREATE TABLE documents (id, url, title, text, text_with_links, text_ner, sent_num);")
+    if compress:
+        c.execute("CREATE TABLE meta (key PRIMARY KEY, value);")
+    c.execute("BEGIN")
 
-    files = list(iter_files(data_path))
-    with Pool(num_workers, initializer=init, initargs=(preprocess,)) as workers, tqdm(total=len(files)) as pbar:
+    compressor = None
+    pending, pending_size = [], 0
+    with Pool(num_workers, initializer=init, initargs=(preprocess, gpu)) as workers, tqdm(total=total) as pbar:
         count = 0
-        for pairs in tqdm(workers.imap_unordered(get_contents, files)):
+        for pairs in tqdm(workers.imap_unordered(get_contents, files, chunksize=16)):
             count += len(pairs)
-            c.executemany("INSERT INTO documents VALUES (?,?,?,?,?,?,?)", pairs)
             pbar.update()
+            if compress and compressor is None:
+                # Hold rows back until there is enough data to train the dictionary
+                pending.extend(pairs)
+                pending_size += blob_size(pairs)
+                if pending_size < ZSTD_SAMPLE_BYTES:
+                    continue
+                compressor = train_compressor(c, pending)
+                pairs, pending = pending, []
+            if compressor is not None:
+                pairs = compress_rows(compressor, pairs)
+            c.executemany("INSERT INTO documents VALUES (?,?,?,?,?,?,?)", pairs)
+    if pending:
+        compressor = train_compressor(c, pending)
+        c.executemany("INSERT INTO documents VALUES (?,?,?,?,?,?,?)", compress_rows(compressor, pending))
     logger.info('Read %d docs.' % count)
+    logger.info('Indexing...')
+    c.execute("CREATE UNIQUE INDEX documents_id ON documents (id);")
     logger.info('Committing...')
     conn.commit()
     conn.close()
@@ -145,8 +269,15 @@ if __name__ == '__main__':
                               'a `preprocess` function'))
     parser.add_argument('--num-workers', type=int, default=None,
                         help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--gpu', action='store_true',
+                        help='Run spacy NER on the GPU (1 worker unless --num-workers is set)')
+    parser.add_argument('--compress', action='store_true',
+                        help='zstd-compress the text, link and NER columns')
+    parser.add_argument('--total', type=int, default=None,
+                        help='Number of files under data_path, for the progress bar')
     args = parser.parse_args()
 
     store_contents(
-        args.data_path, args.save_path, args.preprocess, args.num_workers
+        args.data_path, args.save_path, args.preprocess, args.num_workers, args.gpu,
+        args.compress, args.total
     )
@@ -5,6 +5,7 @@ from unicodedata import normalize as unicodedata_normalize
 from re import compile as re_compile
 from urllib.parse import unquote
 from pickle import loads as pickle_loads
+from zstandard import ZstdDecompressor, ZstdCompressionDict
 
 #input:
 input_file = argv[1]
@@ -12,6 +13,8 @@ db_path = argv[2]
 #output
 output_file = argv[3]
 
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
 EDGE_XY = re_compile(r'<a href="(.*?)">(.*?)</a>')
 def get_edges(sentence):
     #ret = EDGE_XY.findall(sentence)
@@ -32,6 +35,7 @@ class DocDB(object):
     def __init__(self, db_path):
         self.path = db_path
         self.connection = sqlite3_connect(db_path, check_same_thread=False)
+        self.decompressor = self._get_decompressor()
 
     def __enter__(self):
         return self
@@ -47,6 +51,25 @@ class DocDB(object):
         """Close the connection to the database."""
         self.connection.close()
 
+    def _get_decompressor(self):
+        """Build a zstd decompressor, using the dictionary stored by 0_build_db.py --compress if any."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'meta'")
+        result = None
+        if cursor.fetchone() is not None:
+            cursor.execute("SELECT value FROM meta WHERE key = 'zstd_dict'")
+            result = cursor.fetchone()
+        cursor.close()
+        if result is None:
+            return ZstdDecompressor()
+        return ZstdDecompressor(dict_data=ZstdCompressionDict(result[0]))
+
+    def _decompress(self, blob):
+        """Decompress a zstd-compressed blob; plain pickled blobs are returned as is."""
+        if blob is not None and blob[:4] == ZSTD_MAGIC:
+            return self.decompressor.decompress(blob)
+        return blob
+
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
         cursor = self.connection.cursor()
@@ -68,17 +91,17 @@ class DocDB(object):
 
     def get_doc_text(self, doc_id):
         """Fetch the raw text of the doc for 'doc_id'."""
-        return self._get_doc_key(doc_id, 'text')
+        return self._decompress(self._get_doc_key(doc_id, 'text'))
 
 
     def get_doc_sent_num(self, doc_id):
         return int(self._get_doc_key(doc_id, 'sent_num'))
 
     def get_doc_text_with_links(self, doc_id):
-        return self._get_doc_key(doc_id, 'text_with_links')
+        return self._decompress(self._get_doc_key(doc_id, 'text_with_links'))
 
     def get_doc_ner(self, doc_id):
-        return self._get_doc_key(doc_id, 'text_ner')
+        return self._decompress(self._get_doc_key(doc_id, 'text_ner'))
 
     def get_doc_url(self, doc_id):
         return self._get_doc_key(doc_id, 'url')
@@ -1,20 +1,65 @@
-from json import load as json_load, dump as json_dump
-from re import sub as re_sub
+from json import loads as stdlib_json_loads, dumps as stdlib_json_dumps
+from orjson import loads as orjson_loads, dumps as orjson_dumps, JSONDecodeError, JSONEncodeError
+from re import compile as re_compile
 from sys import argv
 from itertools import chain
-from spacy import load as spacy_load
+from os import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from ahocorasick import Automaton
+from spacy import load as spacy_load, prefer_gpu
 from_iterable = chain.from_iterable
 
-input_file = argv[1]
-ner_file = argv[2]
-output_file = argv[3]
-
-nlp = spacy_load("en_core_web_lg", disable=['parser'])
 # ref: https://spacy.io/api/annotation#named-entities
-ent_type = set(["PERSON", "NORP", "FAC", "ORG", "GPE", "LOC", "PRODUCT", "EVENT", "WORK_OF_ART", "LAW", "LANGUAGE"])
+ENT_TYPE = frozenset(["PERSON", "NORP", "FAC", "ORG", "GPE", "LOC", "PRODUCT", "EVENT", "WORK_OF_ART", "LAW", "LANGUAGE"])
             #"DATE", "TIME", "PERCENT", "MONEY", "QUANTITY", "ORDINAL", "CARDINAL"]
 
-def extract_ner_from_titles(sent, titles, context_ners=None):
+TITLE_PAREN = re_compile(r' \(.*?\)$')
+
+def json_loads(data):
+    # orjson refuses lone surrogates and NaN/Infinity, which the stdlib parser accepts
+    try:
+        return orjson_loads(data)
+    except JSONDecodeError:
+        return stdlib_json_loads(data)
+
+def json_dumps(obj):
+    # orjson refuses lone surrogates, which the stdlib encoder escapes
+    try:
+        return orjson_dumps(obj)
+    except JSONEncodeError:
+        return stdlib_json_dumps(obj).encode('ascii')
+
+def build_matcher(titles):
+    # strip the trailing "(disambiguation)" once per title and index all of them
+    # in one automaton, so each sentence is scanned once instead of once per title
+    matcher = Automaton()
+    for idx, title in enumerate(titles):
+        stripped_title = TITLE_PAREN.sub('', title)
+        stripped_lower = stripped_title.lower()
+        if not stripped_lower:
+            continue
+        entry = (idx, len(stripped_lower), len(stripped_title), title)
+        if stripped_lower in matcher:
+            # different titles may strip to the same text
+            matcher.get(stripped_lower).append(entry)
+        else:
+            matcher.add_word(stripped_lower, [entry])
+    if len(matcher) > 0:
+        matcher.make_automaton()
+    return matcher
+
+def find_titles(sent_lower, matcher):
+    # first occurrence of every title, in title order (same as str.find per title)
+    found = {}
+    if len(matcher) > 0:
+        for end_idx, entries in matcher.iter(sent_lower):
+            for idx, lower_len, stripped_len, title in entries:
+                if idx not in found:
+                    start_pos = end_idx - lower_len + 1
+                    found[idx] = (title, start_pos, start_pos + stripped_len)
+    return [found[idx] for idx in sorted(found)]
+
+def extract_ner_from_titles(sent, title_matcher, context_ners=None):
     matched = []
 
     # select candidates for question from all NER in context
@@ -23,25 +68,17 @@ def extract_ner_from_titles(sent, titles, context_ners=None):
         for doc_ner in context_ners:
             all_ents = from_iterable(doc_ner[1])
             for ent in all_ents:
-                if ent[3] in ent_type:
+                if ent[3] in ENT_TYPE:
                     candidates.add(ent[0])
 
     sent_lower = sent.lower()
-    for title in titles:
-        stripped_title = re_sub(r' \(.*?\)$', '', title)
-        start_pos = sent_lower.find(stripped_title.lower())
-        if start_pos != -1:
-            end_pos = start_pos + len(stripped_title)
-            # ! use title rather than the matched text in the question
-            matched.append((title, start_pos, end_pos, 'TITLE'))
-
-    for word in candidates:
-        word = re_sub(r' \(.*?\)$', '', word)
-        start_pos = sent_lower.find(word.lower())
-        if start_pos != -1:
-            end_pos = start_pos + len(word)
-            text = sent[start_pos: end_pos]
-            matched.append((text, start_pos, end_pos, 'CONTEXT'))
+    for title, start_pos, end_pos in find_titles(sent_lower, title_matcher):
+        # ! use title rather than the matched text in the question
+        matched.append((title, start_pos, end_pos, 'TITLE'))
+
+    for _, start_pos, end_pos in find_titles(sent_lower, build_matcher(candidates)):
+        text = sent[start_pos: end_pos]
+        matched.append((text, start_pos, end_pos, 'CONTEXT'))
 
     return matched
 
@@ -50,6 +87,11 @@ def extract_question_ner(full_data):
     all_questions = []
     idx, idx_to_ques = 0, {}
 
+    # load spacy here rather than at import so context workers never load it
+    # run question NER on the GPU when one is available
+    prefer_gpu()
+    nlp = spacy_load("en_core_web_lg", disable=['tagger', 'parser'])
+
     ques_guid2ner = {}
     for case in full_data:
         guid = case['_id']
@@ -64,60 +106,84 @@ def extract_question_ner(full_data):
 
     return ques_guid2ner
 
-def extract_context_ner(full_data, ner_data=None):
-    print("Extract NER from context")
-    sentences = []
-    sent_cnt = 0
-    id_to_sent = {}
+TITLE2NER = None
+
+def init_context_worker(title2ner):
+    # the NER is handed to each worker once instead of being pickled per chunk
+    global TITLE2NER
+    TITLE2NER = title2ner
 
-    context_guid2ner = {}
+def extract_context_chunk(full_data):
+    context_guid2ner, ques_guid2title_ner = {}, {}
     for case in full_data:
         guid = case['_id']
         context_guid2ner[guid] = []
         case_context = case['context']
-        titles = list(dict(case_context).keys())
+        title_matcher = build_matcher([title for title, _ in case_context])
 
         for title, sents in case_context:
             context_ner = []
-            for sent, sent_ner in zip(sents, ner_data[title]['text_ner']):
-                context_ner.append([])
-                for ner in sent_ner:
-                    if ner[3] in ent_type:
-                        context_ner[-1].append(ner)
+            for sent, sent_ner in zip(sents, TITLE2NER[title]):
+                sent_context_ner = [ner for ner in sent_ner if ner[3] in ENT_TYPE]
                 # optional
-                context_ner[-1].extend(extract_ner_from_titles(sent, titles))
+                sent_context_ner.extend(extract_ner_from_titles(sent, title_matcher))
+                context_ner.append(sent_context_ner)
 
             context_guid2ner[guid].append([title, context_ner])
 
-    return context_guid2ner
-
-with open(input_file, 'r') as file_in:
-    data = json_load(file_in)
-# ner_data is from spacy which has been extracted in 0_build_db.py
-with open(ner_file, 'r') as file_in:
-    ner_data = json_load(file_in)
-ques_guid2ner = extract_question_ner(data)
-context_guid2ner = extract_context_ner(data, ner_data)
+        # title & ner in context for the question, reusing the case's title matcher
+        ques_guid2title_ner[guid] = extract_ner_from_titles(case['question'], title_matcher, context_guid2ner[guid])
 
-output_data = {}
-for case in data:
-    guid = case['_id']
-    context = dict(case['context'])
-    question_text = case['question']
-    titles = context.keys()
+    return context_guid2ner, ques_guid2title_ner
 
-    if guid not in output_data:
-        output_data[guid] = {}
-
-    # 1. extract context NER from: 1) spacy; 2) title 
-    context_ners = context_guid2ner[guid]
-
-    # 2. extract question NER from: 1) spacy; 2) title & ner in context
-    ques_ent_1 = ques_guid2ner[guid]
-    ques_ent_2 = extract_ner_from_titles(question_text, titles, context_ners)
-
-    output_data[guid]['question'] = ques_ent_1 + ques_ent_2
-    output_data[guid]['context'] = context_ners
-
-with open(output_file, 'w') as file_out:
-    json_dump(output_data, file_out)
+def extract_context_ner(full_data, ner_data=None, num_workers=None):
+    print("Extract NER from context")
+    # cases are independent, so shard them across processes
+    num_workers = max(1, min(num_workers or cpu_count(), len(full_data)))
+    chunks = [full_data[i::num_workers] for i in range(num_workers)]
+    # workers only read the spacy NER; ner_data also holds the full text of every
+    # linked article, which would otherwise be pickled to each worker under spawn
+    title2ner = {title: doc['text_ner'] for title, doc in ner_data.items()}
+
+    context_guid2ner, ques_guid2title_ner = {}, {}
+    with ProcessPoolExecutor(num_workers, initializer=init_context_worker, initargs=(title2ner,)) as workers:
+        for chunk_guid2ner, chunk_guid2title_ner in workers.map(extract_context_chunk, chunks):
+            context_guid2ner.update(chunk_guid2ner)
+            ques_guid2title_ner.update(chunk_guid2title_ner)
+
+    return context_guid2ner, ques_guid2title_ner
+
+if __name__ == '__main__':
+    input_file = argv[1]
+    ner_file = argv[2]
+    output_file = argv[3]
+    # optional cap on the number of processes for context NER (default: all CPUs)
+    num_workers = int(argv[4]) if len(argv) > 4 else None
+
+    with open(input_file, 'rb') as file_in:
+        data = json_loads(file_in.read())
+    # ner_data is from spacy which has been extracted in 0_build_db.py
+    with open(ner_file, 'rb') as file_in:
+        ner_data = json_loads(file_in.read())
+    ques_guid2ner = extract_question_ner(data)
+    context_guid2ner, ques_guid2title_ner = extract_context_ner(data, ner_data, num_workers)
+
+    # stream one case at a time instead of holding the whole output in memory
+    with open(output_file, 'wb') as file_out:
+        file_out.write(b'{')
+        for case_idx, case in enumerate(data):
+            guid = case['_id']
+
+            # 1. extract context NER from: 1) spacy; 2) title 
+            context_ners = context_guid2ner[guid]
+
+            # 2. extract question NER from: 1) spacy; 2) title & ner in context
+            ques_ent_1 = ques_guid2ner[guid]
+            ques_ent_2 = ques_guid2title_ner[guid]
+
+            if case_idx > 0:
+                file_out.write(b',')
+            file_out.write(json_dumps(guid))
+            file_out.write(b':')
+            file_out.write(json_dumps({'question': ques_ent_1 + ques_ent_2, 'context': context_ners}))
+        file_out.write(b'}')
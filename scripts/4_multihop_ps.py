@@ -11,7 +11,8 @@ with open(argv[1], 'r') as file_in:
     raw_data = json_load(file_in)
 with open(argv[2], 'r') as file_in:
     doc_link_data = json_load(file_in)
-with open(argv[3], 'r') as file_in:
+# ner.json is written as UTF-8 by 2_extract_ner.py
+with open(argv[3], 'r', encoding='utf-8') as file_in:
     ent_data = json_load(file_in)
 with open(argv[4], 'r') as file_in:
     para_data = json_load(file_in)